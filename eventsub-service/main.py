@@ -9,13 +9,19 @@ when it comes online or when VIP status is granted.
 
 import os
 import json
+import hmac
+import math
 import time
 import uuid
 import logging
 import asyncio
 import signal
+import struct
 import sys
 import threading
+import traceback
+import zlib
+from collections import Counter, deque
 from datetime import datetime, timezone
 from typing import Dict, List, Optional, Any, Set
 
@@ -26,7 +32,7 @@ from tenacity import retry, stop_after_attempt, wait_exponential
 from dotenv import load_dotenv
 from google.cloud import firestore
 from google.cloud import logging as gcp_logging
-from flask import Flask, jsonify
+from flask import Flask, jsonify, request
 
 # Load environment variables
 load_dotenv()
@@ -51,6 +57,8 @@ RECONNECT_TIMEOUT = 5  # seconds
 MAX_RECONNECT_ATTEMPTS = 10
 HEARTBEAT_INTERVAL = 10  # seconds
 SESSION_ID = str(uuid.uuid4())
+FIRESTORE_BATCH_LIMIT = 500  # max writes per Firestore batch commit
+AUDIT_MAX_BACKOFF = 60  # seconds between audit commit retries during an outage
 
 # Environment variables
 TWITCH_CLIENT_ID = os.getenv("TWITCH_CLIENT_ID")
@@ -59,6 +67,20 @@ PROJECT_ID = os.getenv("PROJECT_ID")
 PORT = int(os.getenv("PORT", "8080"))
 API_BASE_URL = os.getenv("API_BASE_URL")
 NEXTAUTH_URL = os.getenv("NEXTAUTH_URL")
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "100"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "5"))  # seconds
+AUDIT_BUFFER_LIMIT = int(os.getenv("AUDIT_BUFFER_LIMIT", "5000"))
+AUDIT_DROP_POLICY = os.getenv("AUDIT_DROP_POLICY", "drop_oldest")  # or drop_newest
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "8"))  # seconds; Cloud Run allows 10
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))  # seconds
+SLOW_CALLBACK_THRESHOLD = float(os.getenv("SLOW_CALLBACK_THRESHOLD", "0.25"))  # seconds
+DEBUG_TOKEN = os.getenv("DEBUG_TOKEN")
+MAX_PROFILE_SECONDS = 60
+SNAPSHOT_PATH = os.getenv("SNAPSHOT_PATH", "/tmp/eventsub-snapshot.bin")  # empty disables warm starts
+SNAPSHOT_INTERVAL = float(os.getenv("SNAPSHOT_INTERVAL", "60"))  # seconds
+SNAPSHOT_MAX_AGE = float(os.getenv("SNAPSHOT_MAX_AGE", "86400"))  # seconds
+SNAPSHOT_VERIFY_RETRY = 5  # seconds before the first snapshot verification retry
+SNAPSHOT_VERIFY_MAX_RETRY = 300  # seconds between retries at most
 
 # Use NEXTAUTH_URL as the base URL if available
 BASE_URL = NEXTAUTH_URL or API_BASE_URL or "http://localhost:3000"
@@ -74,10 +96,417 @@ service_status = {
     "session_id": SESSION_ID
 }
 
-# Global service instance and background thread
+# Global service instance, its event loop and background thread
 eventsub_service = None
+service_loop = None
 service_thread = None
 
+class AuditLogWriter:
+    """Buffers audit log entries in memory and writes them to Firestore in batches.
+
+    A flush is triggered when the buffer reaches the batch size or when the flush
+    interval elapses, whichever comes first. Each flush commits one Firestore
+    batch per `batch_size` entries. When the buffer is full, entries are dropped
+    according to the drop policy ("drop_oldest" or "drop_newest").
+    
+    Each entry gets its document ID when it is queued, so retrying a commit that
+    actually reached Firestore overwrites the rows instead of duplicating them.
+    After a failed commit, size triggers are ignored and retries back off
+    exponentially up to AUDIT_MAX_BACKOFF.
+    """
+
+    def __init__(self, db, batch_size=AUDIT_BATCH_SIZE, flush_interval=AUDIT_FLUSH_INTERVAL,
+                 buffer_limit=AUDIT_BUFFER_LIMIT, drop_policy=AUDIT_DROP_POLICY):
+        if drop_policy not in ("drop_oldest", "drop_newest"):
+            raise ValueError(f"Unknown audit drop policy: {drop_policy}")
+        
+        self.db = db
+        self.batch_size = max(1, min(batch_size, FIRESTORE_BATCH_LIMIT))
+        self.flush_interval = flush_interval
+        self.buffer_limit = max(buffer_limit, self.batch_size)
+        self.drop_policy = drop_policy
+        self.buffer = deque()
+        self.flush_task = None
+        self.flush_lock = None
+        self.flush_requested = None
+        self.closing = False
+        self.written = 0
+        self.dropped = 0
+        self.failed_commits = 0
+        self.commits = 0
+        self.retry_delay = 0
+        self.backoff_until = 0
+    
+    def start(self):
+        """Start the background flush task. Must be called from the service event loop."""
+        self.flush_lock = asyncio.Lock()
+        self.flush_requested = asyncio.Event()
+        self.flush_task = asyncio.create_task(self.flush_periodically())
+    
+    def add(self, channel_id, action, username, user_id, details=None):
+        """Queue an audit log entry for the next batch write."""
+        if self.closing:
+            logger.warning(f"Audit writer is closed, dropping {action} entry for channel {channel_id}")
+            self.dropped += 1
+            return
+        
+        entry = {
+            "channelId": channel_id,
+            "action": action,
+            "username": username,
+            "userId": user_id,
+            "details": details or {},
+            "timestamp": datetime.now(timezone.utc)
+        }
+        
+        if len(self.buffer) >= self.buffer_limit and self.drop_policy == "drop_newest":
+            self.dropped += 1
+            logger.warning(f"Audit buffer full, dropping {action} entry for channel {channel_id}")
+            return
+        
+        self.buffer.append((uuid.uuid4().hex, entry))
+        self._enforce_limit()
+        
+        # While backing off after a failed commit, wait for the retry instead
+        if len(self.buffer) >= self.batch_size and self.flush_requested and time.monotonic() >= self.backoff_until:
+            self.flush_requested.set()
+    
+    def _enforce_limit(self):
+        """Drop entries until the buffer fits within its limit."""
+        overflow = len(self.buffer) - self.buffer_limit
+        if overflow <= 0:
+            return
+        
+        for _ in range(overflow):
+            if self.drop_policy == "drop_oldest":
+                self.buffer.popleft()
+            else:
+                self.buffer.pop()
+        self.dropped += overflow
+        logger.warning(f"Audit buffer full, dropped {overflow} entries ({self.drop_policy})")
+    
+    async def flush_periodically(self):
+        """Flush the buffer on size or time triggers until the writer is closed."""
+        while not self.closing:
+            timeout = max(self.flush_interval, self.backoff_until - time.monotonic())
+            try:
+                await asyncio.wait_for(self.flush_requested.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.flush_requested.clear()
+            await self.flush()
+    
+    async def flush(self):
+        """Write all buffered entries to Firestore, one batch commit per `batch_size` entries."""
+        if not self.buffer:
+            return
+        
+        loop = asyncio.get_running_loop()
+        async with self.flush_lock:
+            while self.buffer:
+                entries = [self.buffer.popleft() for _ in range(min(self.batch_size, len(self.buffer)))]
+                batch = self.db.batch()
+                collection = self.db.collection("auditLogs")
+                for entry_id, entry in entries:
+                    batch.set(collection.document(entry_id), entry)
+                
+                try:
+                    # Firestore client is synchronous; keep the commit off the event loop
+                    await loop.run_in_executor(None, batch.commit)
+                    self.commits += 1
+                    self.written += len(entries)
+                    self.retry_delay = 0
+                    self.backoff_until = 0
+                    logger.info(f"Wrote {len(entries)} audit log entries")
+                except asyncio.CancelledError:
+                    # The commit's outcome is unknown; keep the entries so they are reported as
+                    # unwritten (a later retry would overwrite, not duplicate, them)
+                    self.buffer.extendleft(reversed(entries))
+                    self._enforce_limit()
+                    raise
+                except Exception as e:
+                    self.failed_commits += 1
+                    self.retry_delay = min(max(self.retry_delay * 2, self.flush_interval), AUDIT_MAX_BACKOFF)
+                    self.backoff_until = time.monotonic() + self.retry_delay
+                    logger.error(f"Error writing audit log batch, retrying in {self.retry_delay}s: {str(e)}")
+                    # Put the entries back so the next flush retries them
+                    self.buffer.extendleft(reversed(entries))
+                    self._enforce_limit()
+                    break
+    
+    async def close(self):
+        """Stop the flush task and write out anything still buffered."""
+        self.closing = True
+        
+        if self.flush_task and not self.flush_task.done():
+            # Let the flush task write out the buffer and exit; callers bound how long
+            # this may take (drain() uses wait_for), and a batch cut off by that
+            # deadline stays in the buffer as abandoned
+            self.flush_requested.set()
+            try:
+                await self.flush_task
+            except Exception as e:
+                logger.error(f"Audit flush task failed: {str(e)}")
+        elif self.flush_lock:
+            await self.flush()
+        self.flush_task = None
+        
+        if self.buffer:
+            logger.error(f"Audit writer closed with {len(self.buffer)} unwritten entries")
+    
+    def stats(self):
+        """Return counters for the status endpoint."""
+        return {
+            "buffered": len(self.buffer),
+            "written": self.written,
+            "dropped": self.dropped,
+            "commits": self.commits,
+            "failed_commits": self.failed_commits
+        }
+
+class LoopMonitor:
+    """Samples event loop lag and captures the stack of callbacks that block the loop.
+    
+    A task on the monitored loop sleeps for `interval` and records how late it woke
+    up. A watchdog thread notices when that task stops ticking for longer than
+    `slow_threshold` and snapshots the loop thread's stack while it is still blocked.
+    """
+    
+    def __init__(self, interval=LOOP_LAG_INTERVAL, slow_threshold=SLOW_CALLBACK_THRESHOLD,
+                 max_samples=600, max_slow_callbacks=20):
+        self.interval = interval
+        self.slow_threshold = slow_threshold
+        self.samples = deque(maxlen=max_samples)
+        self.slow_callbacks = deque(maxlen=max_slow_callbacks)
+        self.slow_callback_count = 0
+        self.thread_id = None
+        self.last_tick = None
+        self.running = False
+        self.task = None
+        self.watchdog = None
+    
+    def start(self):
+        """Start sampling. Must be called from the loop being monitored."""
+        self.thread_id = threading.get_ident()
+        self.last_tick = time.monotonic()
+        self.running = True
+        self.task = asyncio.create_task(self.sample_lag())
+        self.watchdog = threading.Thread(target=self.watch, name="loop-watchdog", daemon=True)
+        self.watchdog.start()
+    
+    def stop(self):
+        """Stop sampling."""
+        self.running = False
+        if self.task:
+            self.task.cancel()
+            self.task = None
+    
+    async def sample_lag(self):
+        """Record how late the loop wakes a sleeping task."""
+        while self.running:
+            expected = time.monotonic() + self.interval
+            await asyncio.sleep(self.interval)
+            now = time.monotonic()
+            self.samples.append(max(0.0, now - expected))
+            self.last_tick = now
+    
+    def watch(self):
+        """Capture the loop thread's stack whenever the sampler misses its deadline."""
+        captured_tick = None
+        while self.running:
+            time.sleep(self.slow_threshold / 2)
+            tick = self.last_tick
+            blocked = time.monotonic() - tick - self.interval
+            if blocked < self.slow_threshold or tick == captured_tick:
+                continue
+            
+            # Only capture once per stall
+            captured_tick = tick
+            frame = sys._current_frames().get(self.thread_id)
+            stack = traceback.format_stack(frame) if frame else []
+            self.slow_callback_count += 1
+            self.slow_callbacks.append({
+                "detected_at": datetime.now(timezone.utc).isoformat(),
+                "blocked_seconds": round(blocked, 3),
+                "stack": stack
+            })
+            logger.warning(f"Event loop blocked for at least {blocked:.3f}s in:\n{''.join(stack[-5:])}")
+    
+    def stats(self):
+        """Return lag percentiles (in milliseconds) and recent slow callbacks."""
+        samples = sorted(self.samples)
+        
+        def percentile(p):
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(len(samples) * p))] * 1000, 2)
+        
+        return {
+            "samples": len(samples),
+            "lag_ms": {
+                "p50": percentile(0.5),
+                "p99": percentile(0.99),
+                "max": round(samples[-1] * 1000, 2) if samples else None
+            },
+            "slow_callback_threshold_ms": self.slow_threshold * 1000,
+            "slow_callbacks": self.slow_callback_count,
+            "recent_slow_callbacks": list(self.slow_callbacks)
+        }
+
+def profile_thread(thread_id, duration, interval):
+    """Sample a thread's stack for `duration` seconds and aggregate the results.
+    
+    Stacks are returned in folded form ("outer;inner;leaf count"), which flame graph
+    tools such as flamegraph.pl and speedscope accept directly.
+    """
+    stacks = Counter()
+    own = Counter()
+    total = Counter()
+    samples = 0
+    deadline = time.monotonic() + duration
+    
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        if frame is None:
+            break
+        
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            names.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        names.reverse()
+        
+        stacks[";".join(names)] += 1
+        own[names[-1]] += 1
+        for name in set(names):
+            total[name] += 1
+        samples += 1
+        time.sleep(interval)
+    
+    def top(counter):
+        return [
+            {"function": name, "samples": count, "percent": round(count * 100 / samples, 1)}
+            for name, count in counter.most_common(25)
+        ]
+    
+    return {
+        "duration_seconds": duration,
+        "interval_ms": interval * 1000,
+        "samples": samples,
+        "top_self": top(own) if samples else [],
+        "top_cumulative": top(total) if samples else [],
+        "folded": [f"{stack} {count}" for stack, count in stacks.most_common()]
+    }
+
+class BackgroundProfiler:
+    """Runs one `profile_thread` at a time in a background thread and keeps the last report.
+    
+    Profiling inline would tie up the single Gunicorn worker (and with it /health)
+    for the whole profile, so requests only start a run or collect its result.
+    """
+    
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.started_at = None
+        self.report = None
+    
+    def start(self, thread_id, duration, interval):
+        """Start a profile. Returns False if one is already running."""
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return False
+            self.started_at = datetime.now(timezone.utc).isoformat()
+            self.report = None
+            self.thread = threading.Thread(
+                target=self.run, args=(thread_id, duration, interval), name="loop-profiler", daemon=True
+            )
+            self.thread.start()
+            return True
+    
+    def run(self, thread_id, duration, interval):
+        try:
+            self.report = profile_thread(thread_id, duration, interval)
+        except Exception as e:
+            logger.error(f"Error profiling event loop: {str(e)}")
+            self.report = {"error": str(e)}
+    
+    def status(self):
+        """Return the state of the current or last profile."""
+        if self.thread is None:
+            return {"status": "idle"}
+        running = self.thread.is_alive()
+        return {
+            "status": "running" if running else "complete",
+            "started_at": self.started_at,
+            "report": None if running else self.report
+        }
+
+class StateSnapshot:
+    """Compact on-disk snapshot of channel and subscription state for warm starts.
+    
+    The file is a fixed header (magic, format version, save time, CRC32 of the
+    payload) followed by zlib-compressed JSON. Files that are corrupt, from another
+    format version or older than `max_age` are ignored.
+    """
+    
+    MAGIC = b"TRKV"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHdI")
+    
+    def __init__(self, path=SNAPSHOT_PATH, max_age=SNAPSHOT_MAX_AGE):
+        self.path = path
+        self.max_age = max_age
+    
+    def save(self, state):
+        """Atomically write the snapshot, readable only by this user."""
+        payload = zlib.compress(json.dumps(state, separators=(",", ":")).encode("utf-8"))
+        header = self.HEADER.pack(self.MAGIC, self.VERSION, time.time(), zlib.crc32(payload))
+        
+        # Unique per writer so instances sharing a volume don't clobber each other's temp file
+        tmp_path = f"{self.path}.{os.getpid()}.{uuid.uuid4().hex}.tmp"
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(header + payload)
+            os.replace(tmp_path, self.path)
+        except Exception:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return len(header) + len(payload)
+    
+    def load(self):
+        """Return the saved state, or None if there is no usable snapshot."""
+        try:
+            with open(self.path, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        
+        if len(data) < self.HEADER.size:
+            logger.warning(f"Snapshot {self.path} is truncated, ignoring")
+            return None
+        
+        magic, version, saved_at, checksum = self.HEADER.unpack_from(data)
+        payload = data[self.HEADER.size:]
+        if magic != self.MAGIC or version != self.VERSION:
+            logger.warning(f"Snapshot {self.path} has unknown format, ignoring")
+            return None
+        if zlib.crc32(payload) != checksum:
+            logger.warning(f"Snapshot {self.path} failed checksum, ignoring")
+            return None
+        
+        age = time.time() - saved_at
+        if age > self.max_age:
+            logger.info(f"Snapshot {self.path} is {int(age)}s old, ignoring")
+            return None
+        
+        state = json.loads(zlib.decompress(payload).decode("utf-8"))
+        state["age_seconds"] = age
+        return state
+
 class EventSubService:
     def __init__(self):
         self.db = firestore.Client()
@@ -86,29 +515,71 @@ class EventSubService:
         self.keep_running = True
         self.reconnect_attempts = 0
         self.active_subscriptions = set()
+        self.channel_subscriptions = {}
+        self.stale_subscriptions = set()
         self.channels_to_monitor = set()
+        self.reward_ids = set()
+        self.serving_from_snapshot = False
+        self.snapshot_verified = False
+        self.ws_session_id = None
         self.heartbeat_task = None
         self.token_refresh_task = None
+        self.token_task = None
         self.app_access_token = None
         self.token_expiry = 0
         self.session = None
+        self.audit_writer = AuditLogWriter(self.db)
+        self.loop_monitor = LoopMonitor()
+        self.accepting = True
+        self.in_flight = set()
+        self.rejected_events = 0
+        self.drain_task = None
+        self.is_shut_down = False
+        self.snapshot = StateSnapshot() if SNAPSHOT_PATH else None
+        self.snapshot_task = None
+        self.verify_task = None
+        self.started_at = None
+        self.startup = {
+            "warm_start": False,
+            "subscriptions_ready_seconds": None,
+            "first_event_seconds": None
+        }
         
     async def initialize(self):
         """Initialize the service and connect to Twitch EventSub."""
         logger.info(f"Initializing EventSub service with session ID: {self.session_id}")
+        self.started_at = time.monotonic()
+        
+        # Start loop lag sampling
+        self.loop_monitor.start()
         
         # Create aiohttp session
         self.session = aiohttp.ClientSession()
         
-        # Get app access token
-        await self.get_app_access_token()
-        
-        # Load channels to monitor
-        await self.load_channels_to_monitor()
+        if self.restore_snapshot():
+            # Serve from the snapshot now and check it against Firestore/Helix in the background;
+            # the token is fetched alongside the WebSocket handshake rather than before it
+            self.startup["warm_start"] = True
+            self.token_task = asyncio.create_task(self.get_app_access_token())
+            self.verify_task = asyncio.create_task(self.verify_snapshot())
+        else:
+            # Get app access token
+            await self.get_app_access_token()
+            
+            # Load channels to monitor
+            await self.load_channels_to_monitor()
+            self.snapshot_verified = True
         
         # Start token refresh task
         self.token_refresh_task = asyncio.create_task(self.refresh_token_periodically())
         
+        # Start batched audit log writer
+        self.audit_writer.start()
+        
+        # Start periodic snapshots
+        if self.snapshot:
+            self.snapshot_task = asyncio.create_task(self.save_snapshot_periodically())
+        
         # Connect to EventSub
         await self.connect_to_eventsub()
         
@@ -145,8 +616,24 @@ class EventSubService:
             logger.error(f"Error getting app access token: {str(e)}")
             raise
     
+    async def ensure_app_access_token(self):
+        """Wait for the background token fetch started on a warm start, retrying it if it failed."""
+        if self.token_task is None:
+            return
+        
+        try:
+            await self.token_task
+        except Exception:
+            self.token_task = None
+            await self.get_app_access_token()
+    
     async def refresh_token_periodically(self):
         """Periodically refresh the app access token."""
+        try:
+            await self.ensure_app_access_token()
+        except Exception as e:
+            logger.error(f"Failed to get app access token: {str(e)}")
+        
         while self.keep_running:
             # Sleep until token is close to expiry
             time_until_refresh = max(0, self.token_expiry - time.time() - 60)
@@ -167,20 +654,187 @@ class EventSubService:
         try:
             # Get all active channel point rewards
             rewards_ref = self.db.collection("channelPointRewards")
-            rewards = rewards_ref.where("isEnabled", "==", True).stream()
+            query = rewards_ref.where("isEnabled", "==", True)
+            # Firestore client is synchronous; keep the scan off the event loop
+            rewards = await asyncio.get_running_loop().run_in_executor(None, lambda: list(query.stream()))
             
+            channels = set()
+            reward_ids = set()
             for reward in rewards:
                 reward_data = reward.to_dict()
                 channel_id = reward_data.get("channelId")
                 if channel_id:
-                    self.channels_to_monitor.add(channel_id)
+                    channels.add(channel_id)
                     logger.info(f"Added channel to monitor: {channel_id}")
+                if reward_data.get("rewardId"):
+                    reward_ids.add(reward_data["rewardId"])
+            
+            # Replace rather than mutate so concurrent iterations see a consistent set
+            self.channels_to_monitor = channels
+            self.reward_ids = reward_ids
             
             logger.info(f"Loaded {len(self.channels_to_monitor)} channels to monitor")
         except Exception as e:
             logger.error(f"Error loading channels to monitor: {str(e)}")
             raise
     
+    def restore_snapshot(self):
+        """Load channel and subscription state from the local snapshot. Returns True if restored."""
+        if not self.snapshot:
+            return False
+        
+        try:
+            state = self.snapshot.load()
+        except Exception as e:
+            logger.error(f"Error loading snapshot: {str(e)}")
+            return False
+        
+        if not state or not state.get("channels"):
+            return False
+        
+        self.channels_to_monitor = set(state["channels"])
+        self.reward_ids = set(state.get("reward_ids", []))
+        self.serving_from_snapshot = True
+        # Subscriptions from the previous process were bound to its WebSocket session
+        self.stale_subscriptions = set(state.get("subscription_ids", []))
+        
+        logger.info(
+            f"Restored snapshot ({int(state['age_seconds'])}s old, written by session "
+            f"{state.get('owner')}) with {len(self.channels_to_monitor)} channels "
+            f"and {len(self.reward_ids)} rewards"
+        )
+        return True
+    
+    def save_snapshot(self):
+        """Write the current channel, reward and subscription state to the snapshot.
+        
+        The app access token is deliberately not persisted; it is re-fetched on boot.
+        State restored from a snapshot is not saved again until it has been verified,
+        so a failing verification can't keep refreshing the file's timestamp.
+        """
+        if not self.snapshot:
+            return
+        
+        if not self.snapshot_verified:
+            logger.info("Snapshot state not yet verified, skipping save")
+            return
+        
+        state = {
+            "owner": self.session_id,
+            "channels": sorted(self.channels_to_monitor),
+            "reward_ids": sorted(self.reward_ids),
+            "subscription_ids": sorted(self.active_subscriptions | self.stale_subscriptions)
+        }
+        
+        try:
+            size = self.snapshot.save(state)
+            logger.debug(f"Saved {size} byte snapshot to {self.snapshot.path}")
+        except Exception as e:
+            logger.error(f"Error saving snapshot: {str(e)}")
+    
+    async def save_snapshot_periodically(self):
+        """Periodically save the snapshot."""
+        while self.keep_running:
+            await asyncio.sleep(SNAPSHOT_INTERVAL)
+            if self.keep_running:
+                self.save_snapshot()
+    
+    async def verify_snapshot(self):
+        """Reconcile state restored from the snapshot, retrying with backoff until it succeeds."""
+        delay = SNAPSHOT_VERIFY_RETRY
+        while self.keep_running:
+            verified = await self.reconcile_snapshot()
+            # Redemptions go back to checking each reward against Firestore after the first attempt
+            self.serving_from_snapshot = False
+            if verified:
+                return
+            
+            logger.info(f"Retrying snapshot verification in {delay}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SNAPSHOT_VERIFY_MAX_RETRY)
+    
+    async def reconcile_snapshot(self):
+        """Reconcile state restored from the snapshot with Helix and Firestore. Returns True on success."""
+        try:
+            await self.ensure_app_access_token()
+            
+            previous = self.channels_to_monitor
+            await self.load_channels_to_monitor()
+            added = self.channels_to_monitor - previous
+            removed = previous - self.channels_to_monitor
+            
+            for channel_id in removed:
+                logger.info(f"Channel {channel_id} is no longer monitored, removing its subscriptions")
+                await self.delete_channel_subscriptions(channel_id)
+            
+            # Channels added since the snapshot are picked up by the welcome handler if it hasn't run yet
+            if self.ws_session_id:
+                for channel_id in added:
+                    if not self.channel_subscriptions.get(channel_id):
+                        await self.create_channel_subscriptions(channel_id, self.ws_session_id)
+            
+            # Clean up subscriptions left behind by a previous process (e.g. after a crash). The
+            # snapshot may have been written by another live instance, so only delete IDs that
+            # Twitch reports as disconnected.
+            disconnected = await self.get_disconnected_subscription_ids()
+            stale = set()
+            if disconnected is not None:
+                stale = (self.stale_subscriptions & disconnected) - self.active_subscriptions
+                self.stale_subscriptions = set()
+                for subscription_id in stale:
+                    await self.delete_subscription(subscription_id)
+            
+            self.snapshot_verified = True
+            self.save_snapshot()
+            logger.info(
+                f"Verified snapshot: {len(added)} channels added, {len(removed)} removed, "
+                f"{len(stale)} stale subscriptions cleaned up"
+            )
+            return True
+        except Exception as e:
+            logger.error(f"Error verifying snapshot: {str(e)}")
+            return False
+    
+    async def get_disconnected_subscription_ids(self):
+        """Return IDs of subscriptions whose WebSocket has disconnected, or None on error."""
+        headers = {
+            "Client-ID": TWITCH_CLIENT_ID,
+            "Authorization": f"Bearer {self.app_access_token}"
+        }
+        params = {"status": "websocket_disconnected"}
+        subscription_ids = set()
+        
+        try:
+            while True:
+                async with self.session.get(
+                    f"{TWITCH_API_BASE}/eventsub/subscriptions",
+                    headers=headers,
+                    params=params
+                ) as response:
+                    if response.status != 200:
+                        error_text = await response.text()
+                        logger.error(f"Failed to list disconnected subscriptions: {error_text}")
+                        return None
+                    
+                    response_data = await response.json()
+                
+                subscription_ids.update(sub["id"] for sub in response_data.get("data", []))
+                cursor = response_data.get("pagination", {}).get("cursor")
+                if not cursor:
+                    return subscription_ids
+                params["after"] = cursor
+        except Exception as e:
+            logger.error(f"Error listing disconnected subscriptions: {str(e)}")
+            return None
+    
+    def record_startup_metric(self, name):
+        """Record seconds since initialization for a startup milestone, once."""
+        if self.started_at is None or self.startup[name] is not None:
+            return
+        
+        self.startup[name] = round(time.monotonic() - self.started_at, 3)
+        logger.info(f"Startup {name}: {self.startup[name]}s (warm_start={self.startup['warm_start']})")
+    
     @backoff.on_exception(
         backoff.expo,
         (websockets.exceptions.ConnectionClosed, 
@@ -210,6 +864,10 @@ class EventSubService:
                 self.heartbeat_task.cancel()
                 self.heartbeat_task = None
             
+            if not self.keep_running:
+                logger.info("Service is stopping, not reconnecting")
+                return
+            
             self.reconnect_attempts += 1
             if self.reconnect_attempts >= MAX_RECONNECT_ATTEMPTS:
                 logger.error("Max reconnect attempts reached, giving up")
@@ -256,10 +914,20 @@ class EventSubService:
         """Handle welcome message from EventSub."""
         session_id = data.get("payload", {}).get("session", {}).get("id")
         logger.info(f"Connected to EventSub with session ID: {session_id}")
+        self.ws_session_id = session_id
         
-        # Create subscriptions for all monitored channels
-        for channel_id in self.channels_to_monitor:
+        await self.ensure_app_access_token()
+        
+        # Create subscriptions for all monitored channels. verify_snapshot may drop channels
+        # while this loop awaits, so re-check membership before and after subscribing.
+        for channel_id in list(self.channels_to_monitor):
+            if channel_id not in self.channels_to_monitor:
+                continue
             await self.create_channel_subscriptions(channel_id, session_id)
+            if channel_id not in self.channels_to_monitor:
+                await self.delete_channel_subscriptions(channel_id)
+        
+        self.record_startup_metric("subscriptions_ready_seconds")
     
     async def create_channel_subscriptions(self, channel_id, session_id):
         """Create EventSub subscriptions for a channel."""
@@ -327,6 +995,7 @@ class EventSubService:
                 subscription_id = response_data.get("data", [{}])[0].get("id")
                 if subscription_id:
                     self.active_subscriptions.add(subscription_id)
+                    self.channel_subscriptions.setdefault(condition.get("broadcaster_user_id"), set()).add(subscription_id)
                     logger.info(f"Created subscription {subscription_id} for {subscription_type}")
                     return True
                 else:
@@ -342,17 +1011,40 @@ class EventSubService:
             subscription_type = data.get("metadata", {}).get("subscription_type")
             event_data = data.get("payload", {}).get("event", {})
             
+            if not self.accepting:
+                self.rejected_events += 1
+                logger.warning(f"Service is draining, rejecting notification for {subscription_type}")
+                return
+            
             logger.info(f"Received notification for {subscription_type}")
+            self.record_startup_metric("first_event_seconds")
             
             if subscription_type == "channel.channel_points_custom_reward_redemption.add":
-                await self.handle_redemption(event_data)
+                await self.run_tracked(self.handle_redemption(event_data))
             elif subscription_type == "channel.vip.add":
-                await self.handle_vip_add(event_data)
+                await self.run_tracked(self.handle_vip_add(event_data))
             elif subscription_type == "channel.vip.remove":
-                await self.handle_vip_remove(event_data)
+                await self.run_tracked(self.handle_vip_remove(event_data))
         except Exception as e:
             logger.error(f"Error handling notification: {str(e)}")
     
+    async def run_tracked(self, coro):
+        """Run a handler to completion, tracked so that drain() can wait for it.
+        
+        Notifications are still handled one at a time and in order; the handler only
+        runs as its own task so drain() can wait on it and cancel it at the deadline.
+        """
+        task = asyncio.create_task(coro)
+        self.in_flight.add(task)
+        task.add_done_callback(self.in_flight.discard)
+        try:
+            # Shield so cancelling the message loop doesn't cancel the handler mid-grant
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if not task.cancelled():
+                raise
+            logger.warning("Notification handler abandoned at shutdown deadline")
+    
     async def handle_redemption(self, event_data):
         """Handle channel point redemption event."""
         try:
@@ -365,13 +1057,27 @@ class EventSubService:
             
             logger.info(f"Channel point redemption: {user_name} redeemed {reward_title} in channel {broadcaster_id}")
             
-            # Check if this reward is for VIP status
-            reward_ref = self.db.collection("channelPointRewards").where("rewardId", "==", reward_id).limit(1).stream()
-            reward_docs = list(reward_ref)
+            self.audit_writer.add(
+                broadcaster_id,
+                "REWARD_REDEEMED",
+                user_name,
+                user_id,
+                {
+                    "rewardId": reward_id,
+                    "rewardTitle": reward_title,
+                    "redemptionId": redemption_id
+                }
+            )
             
-            if not reward_docs:
-                logger.info(f"Reward {reward_id} not found in database, ignoring")
-                return
+            # Check if this reward is for VIP status; the snapshot's reward index stands in for
+            # Firestore only until verify_snapshot has reloaded it
+            if not (self.serving_from_snapshot and reward_id in self.reward_ids):
+                reward_ref = self.db.collection("channelPointRewards").where("rewardId", "==", reward_id).limit(1).stream()
+                reward_docs = list(reward_ref)
+                
+                if not reward_docs:
+                    logger.info(f"Reward {reward_id} not found in database, ignoring")
+                    return
             
             # Process the redemption by calling the API
             await self.process_vip_redemption(broadcaster_id, user_id, user_name, reward_id, reward_title, redemption_id)
@@ -448,6 +1154,8 @@ class EventSubService:
         user_name = event_data.get("user_name")
         
         logger.info(f"VIP added: {user_name} in channel {broadcaster_id}")
+        
+        self.audit_writer.add(broadcaster_id, "VIP_ADDED", user_name, user_id, {"method": "eventsub"})
     
     async def handle_vip_remove(self, event_data):
         """Handle VIP remove event."""
@@ -456,6 +1164,8 @@ class EventSubService:
         user_name = event_data.get("user_name")
         
         logger.info(f"VIP removed: {user_name} from channel {broadcaster_id}")
+        
+        self.audit_writer.add(broadcaster_id, "VIP_REMOVED", user_name, user_id, {"method": "eventsub"})
     
     async def handle_reconnect(self, data):
         """Handle reconnect message from EventSub."""
@@ -484,6 +1194,8 @@ class EventSubService:
                 await self.process_messages()
         except Exception as e:
             logger.error(f"Reconnect error: {str(e)}")
+            if not self.keep_running:
+                return
             # Fall back to normal connection
             await self.connect_to_eventsub()
     
@@ -494,8 +1206,14 @@ class EventSubService:
         
         logger.warning(f"Subscription {subscription_id} revoked with status {status}")
         
-        if subscription_id in self.active_subscriptions:
-            self.active_subscriptions.remove(subscription_id)
+        self.forget_subscription(subscription_id)
+    
+    def forget_subscription(self, subscription_id):
+        """Remove a subscription from local tracking."""
+        self.active_subscriptions.discard(subscription_id)
+        self.stale_subscriptions.discard(subscription_id)
+        for subscription_ids in self.channel_subscriptions.values():
+            subscription_ids.discard(subscription_id)
     
     async def send_heartbeat(self):
         """Send periodic heartbeats to keep the connection alive."""
@@ -519,6 +1237,9 @@ class EventSubService:
     
     async def notify_channels_service_online(self):
         """Notify all monitored channels that the service is online."""
+        if not self.keep_running:
+            return
+        
         logger.info("Notifying channels that service is online")
         
         for channel_id in self.channels_to_monitor:
@@ -598,11 +1319,107 @@ class EventSubService:
         except Exception as e:
             logger.error(f"Error notifying channel {channel_id} about VIP grant: {str(e)}")
     
+    async def delete_subscription(self, subscription_id):
+        """Delete an EventSub subscription."""
+        try:
+            headers = {
+                "Client-ID": TWITCH_CLIENT_ID,
+                "Authorization": f"Bearer {self.app_access_token}"
+            }
+            
+            async with self.session.delete(
+                f"{TWITCH_API_BASE}/eventsub/subscriptions",
+                headers=headers,
+                params={"id": subscription_id}
+            ) as response:
+                if response.status != 204:
+                    error_text = await response.text()
+                    logger.error(f"Failed to delete subscription {subscription_id}: {error_text}")
+                    return False
+                
+                self.forget_subscription(subscription_id)
+                logger.info(f"Deleted subscription {subscription_id}")
+                return True
+        except Exception as e:
+            logger.error(f"Error deleting subscription {subscription_id}: {str(e)}")
+            return False
+    
+    async def delete_channel_subscriptions(self, channel_id):
+        """Delete all tracked subscriptions for a channel."""
+        for subscription_id in list(self.channel_subscriptions.get(channel_id, ())):
+            await self.delete_subscription(subscription_id)
+    
+    async def drain(self, timeout=SHUTDOWN_DRAIN_TIMEOUT):
+        """Stop intake, let in-flight handlers finish, flush buffers and release subscriptions.
+        
+        Returns a report of how much work was drained versus abandoned.
+        """
+        self.drain_task = asyncio.current_task()
+        started = time.monotonic()
+        deadline = started + timeout
+        logger.info(f"Draining EventSub service ({len(self.in_flight)} handlers in flight, {timeout}s deadline)")
+        
+        # Stop intake; further notifications are counted as rejected
+        self.accepting = False
+        self.keep_running = False
+        
+        pending = set(self.in_flight)
+        in_flight_at_start = len(pending)
+        subscriptions = list(self.active_subscriptions)
+        deleted = 0
+        audit_written = self.audit_writer.written
+        try:
+            # Let in-flight handlers finish within the deadline
+            if pending:
+                _, pending = await asyncio.wait(pending, timeout=max(0, deadline - time.monotonic()))
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+            
+            # Flush buffered audit log entries; a batch cut off by the deadline stays buffered
+            try:
+                await asyncio.wait_for(self.audit_writer.close(), timeout=max(0.1, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                logger.error("Timed out flushing audit log entries")
+            
+            # Release this session's subscriptions so they don't linger as disabled
+            if subscriptions and self.session and not self.session.closed:
+                try:
+                    results = await asyncio.wait_for(
+                        asyncio.gather(*(self.delete_subscription(sub_id) for sub_id in subscriptions)),
+                        timeout=max(0.1, deadline - time.monotonic())
+                    )
+                    deleted = sum(1 for result in results if result)
+                except asyncio.TimeoutError:
+                    logger.error("Timed out deleting subscriptions")
+                    deleted = len(subscriptions) - len(self.active_subscriptions)
+        finally:
+            # Always release connections, even if the drain itself was cancelled
+            await self.shutdown()
+        
+        report = {
+            "handlers_drained": in_flight_at_start - len(pending),
+            "handlers_abandoned": len(pending),
+            "events_rejected": self.rejected_events,
+            "audit_entries_flushed": self.audit_writer.written - audit_written,
+            "audit_entries_abandoned": len(self.audit_writer.buffer),
+            "subscriptions_deleted": deleted,
+            "subscriptions_abandoned": len(subscriptions) - deleted,
+            "elapsed_seconds": round(time.monotonic() - started, 3)
+        }
+        logger.info(f"EventSub service drained: {report}")
+        return report
+    
     async def shutdown(self):
         """Shutdown the service gracefully."""
+        if self.is_shut_down:
+            return
+        self.is_shut_down = True
+        
         logger.info("Shutting down EventSub service")
         
         self.keep_running = False
+        self.accepting = False
         
         # Cancel tasks
         if self.heartbeat_task:
@@ -611,10 +1428,32 @@ class EventSubService:
         if self.token_refresh_task:
             self.token_refresh_task.cancel()
         
+        if self.snapshot_task:
+            self.snapshot_task.cancel()
+        
+        if self.verify_task:
+            self.verify_task.cancel()
+        
+        if self.token_task:
+            self.token_task.cancel()
+        
+        self.loop_monitor.stop()
+        
         # Close WebSocket connection
         if self.ws:
             await self.ws.close()
         
+        # Flush buffered audit log entries, unless drain() already tried within its deadline
+        if not self.audit_writer.closing:
+            await self.audit_writer.close()
+        
+        # Abandon handlers that are still running
+        for task in list(self.in_flight):
+            task.cancel()
+        
+        # Persist state for the next warm start
+        self.save_snapshot()
+        
         # Close aiohttp session
         if self.session:
             await self.session.close()
@@ -627,9 +1466,72 @@ async def shutdown(service):
     service_status["status"] = "shutting_down"
     await service.shutdown()
 
+class ShutdownCoordinator:
+    """Drains the EventSub service when the process receives SIGTERM or SIGINT.
+    
+    The service runs on its own event loop in a background thread, so the signal
+    handler (which runs in the main thread) schedules `EventSubService.drain` on
+    that loop and waits for it before handing the signal on to whatever handler
+    was installed before (e.g. Gunicorn's worker exit handler).
+    """
+    
+    def __init__(self, drain_timeout=SHUTDOWN_DRAIN_TIMEOUT):
+        self.drain_timeout = drain_timeout
+        self.previous_handlers = {}
+        self.lock = threading.Lock()
+        self.draining = False
+        self.report = None
+    
+    def install(self):
+        """Install the signal handlers. Only possible from the main thread."""
+        if threading.current_thread() is not threading.main_thread():
+            logger.warning("Not in main thread, shutdown signal handlers not installed")
+            return
+        
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            self.previous_handlers[sig] = signal.getsignal(sig)
+            signal.signal(sig, self.handle_signal)
+    
+    def handle_signal(self, signum, frame):
+        """Drain the service, then defer to the previously installed handler."""
+        logger.info(f"Received {signal.Signals(signum).name}, draining EventSub service")
+        self.drain()
+        
+        previous = self.previous_handlers.get(signum)
+        if callable(previous):
+            previous(signum, frame)
+        elif previous == signal.SIG_DFL:
+            signal.signal(signum, signal.SIG_DFL)
+            os.kill(os.getpid(), signum)
+    
+    def drain(self):
+        """Drain the running service once and return the drain report."""
+        with self.lock:
+            if self.draining:
+                return self.report
+            self.draining = True
+        
+        service_status["status"] = "shutting_down"
+        service, loop = eventsub_service, service_loop
+        if service is None or loop is None or loop.is_closed():
+            logger.info("EventSub service not running, nothing to drain")
+            return None
+        
+        future = asyncio.run_coroutine_threadsafe(service.drain(self.drain_timeout), loop)
+        try:
+            # Allow a little slack past the drain deadline for the final shutdown steps
+            self.report = future.result(timeout=self.drain_timeout + 2)
+        except Exception as e:
+            logger.error(f"Error draining EventSub service: {str(e)}")
+            future.cancel()
+        
+        service_status["shutdown"] = self.report
+        return self.report
+
 def create_app():
     """Create and configure the Flask application."""
     app = Flask(__name__)
+    profiler = BackgroundProfiler()
     
     @app.route('/')
     def home():
@@ -657,10 +1559,62 @@ def create_app():
             "session_id": SESSION_ID,
             "timestamp": datetime.now(timezone.utc).isoformat(),
             "thread_running": service_thread is not None and service_thread.is_alive() if service_thread else False,
-            "service_initialized": eventsub_service is not None
+            "service_initialized": eventsub_service is not None,
+            "audit_log": eventsub_service.audit_writer.stats() if eventsub_service else None,
+            "startup": eventsub_service.startup if eventsub_service else None
         }
         return jsonify(detailed_status)
     
+    def debug_authorized():
+        """Debug endpoints are only enabled when DEBUG_TOKEN is set and supplied."""
+        if not DEBUG_TOKEN:
+            return False
+        supplied = request.headers.get("Authorization", "")
+        return hmac.compare_digest(supplied.encode("utf-8"), f"Bearer {DEBUG_TOKEN}".encode("utf-8"))
+    
+    @app.route('/debug/loop')
+    def debug_loop():
+        """Event loop lag statistics and stacks of recent slow callbacks."""
+        if not debug_authorized():
+            return jsonify({"error": "Unauthorized"}), 401
+        if eventsub_service is None or eventsub_service.loop_monitor.thread_id is None:
+            return jsonify({"error": "Service not running"}), 503
+        return jsonify(eventsub_service.loop_monitor.stats())
+    
+    @app.route('/debug/profile', methods=['POST'])
+    def start_profile():
+        """Start a time-boxed sampling profile of the service event loop thread."""
+        if not debug_authorized():
+            return jsonify({"error": "Unauthorized"}), 401
+        if eventsub_service is None or eventsub_service.loop_monitor.thread_id is None:
+            return jsonify({"error": "Service not running"}), 503
+        
+        try:
+            seconds = float(request.args.get("seconds", "10"))
+            interval_ms = float(request.args.get("interval_ms", "10"))
+        except ValueError:
+            return jsonify({"error": "seconds and interval_ms must be numbers"}), 400
+        if not (math.isfinite(seconds) and math.isfinite(interval_ms)) or seconds <= 0 or interval_ms <= 0:
+            return jsonify({"error": "seconds and interval_ms must be positive finite numbers"}), 400
+        
+        seconds = min(seconds, MAX_PROFILE_SECONDS)
+        interval_ms = max(interval_ms, 1)
+        if not profiler.start(eventsub_service.loop_monitor.thread_id, seconds, interval_ms / 1000):
+            return jsonify({"error": "A profile is already running", **profiler.status()}), 409
+        return jsonify({"status": "running", "seconds": seconds, "interval_ms": interval_ms}), 202
+    
+    @app.route('/debug/profile', methods=['GET'])
+    def get_profile():
+        """Return the state of the current profile, or the report of the last one."""
+        if not debug_authorized():
+            return jsonify({"error": "Unauthorized"}), 401
+        
+        status = profiler.status()
+        report = status.get("report")
+        if request.args.get("format") == "folded" and report and "folded" in report:
+            return "\n".join(report["folded"]) + "\n", 200, {"Content-Type": "text/plain"}
+        return jsonify(status)
+    
     @app.route('/start', methods=['POST'])
     def start_service():
         """Start the EventSub service if it's not already running."""
@@ -697,13 +1651,14 @@ def create_app():
 
 def run_service():
     """Run the EventSub service in the current thread."""
-    global eventsub_service, service_status
+    global eventsub_service, service_loop, service_status
     
     logger.info("Starting EventSub service")
     
     # Create event loop for this thread
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
+    service_loop = loop
     
     try:
         # Initialize service
@@ -711,7 +1666,8 @@ def run_service():
         
         # Initialize and start the service
         loop.run_until_complete(eventsub_service.initialize())
-        service_status["status"] = "running"
+        if eventsub_service.keep_running:
+            service_status["status"] = "running"
         
         # Keep the service running
         while eventsub_service.keep_running:
@@ -721,15 +1677,27 @@ def run_service():
         logger.error(f"Error in EventSub service: {str(e)}")
         service_status["status"] = "error"
     finally:
-        # Cleanup
-        if eventsub_service:
-            loop.run_until_complete(eventsub_service.shutdown())
-        loop.close()
-        logger.info("EventSub service stopped")
+        # Cleanup; let a drain started by the signal handler finish first
+        try:
+            if eventsub_service:
+                if eventsub_service.drain_task:
+                    try:
+                        loop.run_until_complete(eventsub_service.drain_task)
+                    except (Exception, asyncio.CancelledError) as e:
+                        logger.error(f"Error draining EventSub service: {e!r}")
+                loop.run_until_complete(eventsub_service.shutdown())
+        finally:
+            service_loop = None
+            loop.close()
+            logger.info("EventSub service stopped")
 
 # Create the application
 app = create_app()
 
+# Drain the service on SIGTERM (Cloud Run scale-down/deploy) and SIGINT
+shutdown_coordinator = ShutdownCoordinator()
+shutdown_coordinator.install()
+
 if __name__ == "__main__":
     # Run the Flask app
     app.run(host="0.0.0.0", port=PORT) 
\ No newline at end of file
@@ -166,6 +166,15 @@ export default function AuditLog({ channelId, limit = 50, action }: AuditLogProp
               {log.action === 'VIP_GRANT_FAILED' && (
                 <span className="text-red-400">Grant Failed</span>
               )}
+              {log.action === 'VIP_ADDED' && (
+                <span className="text-green-400">VIP Added</span>
+              )}
+              {log.action === 'VIP_REMOVED' && (
+                <span className="text-gray-400">VIP Removed</span>
+              )}
+              {log.action === 'REWARD_REDEEMED' && (
+                <span className="text-purple-400">Reward Redeemed</span>
+              )}
             </div>
           </div>
           {log.details && (